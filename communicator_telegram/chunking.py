@@ -0,0 +1,97 @@
+# -*- coding: UTF-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+__author__ = "d01"
+__email__ = "jungflor@gmail.com"
+__copyright__ = "Copyright (C) 2017-20, Florian JUNG"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__date__ = "2026-10-19"
+# Created: 2026-10-19 15:45
+
+import typing
+
+from telegram.constants import MAX_MESSAGE_LENGTH
+
+
+BOUNDARIES = ("\n\n", "\n", ". ", "! ", "? ", "; ", ", ", " ")
+""" Preferred places to split text (best first) """
+
+
+def _find_cut(text: str, limit: int) -> int:
+    window = text[:limit]
+
+    for sep in BOUNDARIES:
+        i = window.rfind(sep)
+        # Don't produce tiny chunks for a slightly better boundary
+        if i > limit // 2:
+            return i + len(sep)
+    return limit
+
+
+def split_text(text: str, limit: int = MAX_MESSAGE_LENGTH) -> typing.List[str]:
+    """
+    Split text into parts of at most limit characters
+    at paragraph, line, sentence or word boundaries
+
+    :param text: Text to split
+    :param limit: Max length of a part
+    :return: Parts
+    """
+    parts = []
+
+    while len(text) > limit:
+        cut = _find_cut(text, limit)
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+def is_image(item: typing.Any) -> bool:
+    return isinstance(item, dict) and item.get('type') == "image"
+
+
+def coalesce(
+        items: typing.List[typing.Union[str, dict]],
+        limit: int = MAX_MESSAGE_LENGTH, separator: str = "\n",
+        merge: bool = True,
+) -> typing.List[typing.Union[str, dict]]:
+    """
+    Prepare items for sending: split long texts and merge consecutive
+    texts into as few messages as fit the limit (images are kept as is)
+
+    :param items: Items to send
+    :param limit: Max message length
+    :param separator: Put between merged texts
+    :param merge: Merge consecutive texts
+    :return: Items to send
+    """
+    result = []
+    buf = None
+
+    for item in items:
+        if is_image(item):
+            if buf is not None:
+                result.append(buf)
+                buf = None
+            result.append(item)
+            continue
+        if not item:
+            continue
+
+        for chunk in split_text("{}".format(item), limit):
+            if buf is not None and merge \
+                    and len(buf) + len(separator) + len(chunk) <= limit:
+                buf += separator + chunk
+                continue
+            if buf is not None:
+                result.append(buf)
+            buf = chunk
+    if buf is not None:
+        result.append(buf)
+    return result
@@ -0,0 +1,215 @@
+# -*- coding: UTF-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+__author__ = "d01"
+__email__ = "jungflor@gmail.com"
+__copyright__ = "Copyright (C) 2017-20, Florian JUNG"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__date__ = "2026-10-19"
+# Created: 2026-10-19 13:05
+
+from collections import OrderedDict
+import threading
+import time
+import typing
+
+from flotils import Logable
+
+
+class TokenBucket(object):
+    """ Allow rate events per second with bursts up to burst events """
+
+    __slots__ = ("rate", "burst", "tokens", "last")
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def take(self, now: float) -> bool:
+        """
+        Take one token
+
+        :param now: Current (monotonic) time
+        :return: Token available
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+
+class FloodGate(Logable):
+    """ Cheap checks to drop updates before parsing them """
+
+    def __init__(
+            self, settings: typing.Optional[typing.Dict[str, typing.Any]] = None
+    ) -> None:
+        """
+        Initialize object
+
+        :param settings: Settings for instance (default: None)
+        """
+        if settings is None:
+            settings = {}
+        super(FloodGate, self).__init__(settings)
+        self._user_rate: typing.Optional[float] = settings.get(
+            'flood_user_rate', None
+        )
+        """ Updates per second per user (None -> no limit) """
+        self._user_burst: float = settings.get('flood_user_burst', 10)
+        self._chat_rate: typing.Optional[float] = settings.get(
+            'flood_chat_rate', None
+        )
+        """ Updates per second per chat (None -> no limit) """
+        self._chat_burst: float = settings.get('flood_chat_burst', 30)
+        self._max_tracked: int = settings.get('flood_max_tracked', 10000)
+        """ Max buckets kept per kind (least recently used dropped) """
+        self._block_time: float = settings.get('unknown_block_time', 60.0)
+        """ Time to drop updates of users found to be unknown """
+        self._log_interval: float = settings.get('reject_log_interval', 10.0)
+        """ Min time between reject log entries """
+        self._blocked: typing.Set[int] = set(settings.get('blocked_ids', []))
+        """ Always dropped user/chat ids """
+        self._blocked_until: typing.MutableMapping[int, float] = OrderedDict()
+        """ Temporarily dropped user ids (max flood_max_tracked) """
+        self._users: typing.MutableMapping[int, TokenBucket] = OrderedDict()
+        self._chats: typing.MutableMapping[int, TokenBucket] = OrderedDict()
+        self._lock = threading.Lock()
+        self._rejects: typing.Dict[str, int] = {}
+        """ Rejects since last log """
+        self._rejects_total: int = 0
+        self._last_log: typing.Optional[float] = None
+
+    def block(self, id_: int, duration: typing.Optional[float] = None) -> None:
+        """
+        Drop all updates from user/chat
+
+        :param id_: User or chat id
+        :param duration: Seconds to block (None -> until unblocked)
+        """
+        with self._lock:
+            if duration is None:
+                self._blocked.add(id_)
+            else:
+                now = time.monotonic()
+                self._blocked_until[id_] = now + duration
+                self._blocked_until.move_to_end(id_)
+                self._prune_blocked(now)
+
+    def _prune_blocked(self, now: float) -> None:
+        """
+        Drop expired (oldest first) and least recently blocked ids over limit
+
+        :param now: Current (monotonic) time
+        """
+        blocked = self._blocked_until
+
+        while blocked:
+            until = next(iter(blocked.values()))
+            if until > now and len(blocked) <= self._max_tracked:
+                break
+            blocked.popitem(last=False)
+
+    def block_unknown(self, user_id: int) -> None:
+        """
+        Drop updates of unknown user for a while (skip lookups)
+
+        :param user_id: User id
+        """
+        if self._block_time:
+            self.block(user_id, self._block_time)
+
+    def unblock(self, id_: int) -> None:
+        with self._lock:
+            self._blocked.discard(id_)
+            self._blocked_until.pop(id_, None)
+
+    def _bucket_take(
+            self, buckets: typing.MutableMapping[int, TokenBucket], id_: int,
+            rate: float, burst: float, now: float,
+    ) -> bool:
+        bucket = buckets.get(id_)
+
+        if bucket is None:
+            bucket = buckets[id_] = TokenBucket(rate, burst, now)
+            if len(buckets) > self._max_tracked:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(id_)
+        return bucket.take(now)
+
+    def check(
+            self, user_id: int, chat_id: typing.Optional[int] = None,
+            rate_limit: bool = True,
+    ) -> typing.Optional[str]:
+        """
+        Check whether an update should be dropped
+
+        :param user_id: Sending user
+        :param chat_id: Chat of update
+        :param rate_limit: Count update against rate limits
+        :return: Reason to drop or None if allowed
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            if user_id in self._blocked or chat_id in self._blocked:
+                return "blocked"
+            if user_id in self._blocked_until:
+                if now < self._blocked_until[user_id]:
+                    return "unknown"
+                del self._blocked_until[user_id]
+            if not rate_limit:
+                return None
+            if self._user_rate and not self._bucket_take(
+                    self._users, user_id,
+                    self._user_rate, self._user_burst, now
+            ):
+                return "user flood"
+            if self._chat_rate and chat_id is not None \
+                    and not self._bucket_take(
+                        self._chats, chat_id,
+                        self._chat_rate, self._chat_burst, now
+                    ):
+                return "chat flood"
+        return None
+
+    def reject(self, reason: str, who: typing.Any = None) -> None:
+        """
+        Count dropped update and log (rate limited)
+
+        :param reason: Why it was dropped
+        :param who: Short description of sender for log
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            self._rejects[reason] = self._rejects.get(reason, 0) + 1
+            self._rejects_total += 1
+            if self._last_log is not None \
+                    and now - self._last_log < self._log_interval:
+                return
+            rejects = self._rejects
+            self._rejects = {}
+            self._last_log = now
+        self.warning("Dropped updates {} (last: {} - {})".format(
+            rejects, reason, who
+        ))
+
+    def get_stats(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            return {
+                'rejected': self._rejects_total,
+                'blocked': len(self._blocked),
+                'blocked_temporary': len(self._blocked_until),
+                'tracked_users': len(self._users),
+                'tracked_chats': len(self._chats),
+            }
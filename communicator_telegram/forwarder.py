@@ -0,0 +1,144 @@
+# -*- coding: UTF-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+__author__ = "d01"
+__email__ = "jungflor@gmail.com"
+__copyright__ = "Copyright (C) 2017-20, Florian JUNG"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__date__ = "2026-10-19"
+# Created: 2026-10-19 12:25
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import typing
+
+from flotils import Logable
+
+
+class ChatForwarder(Logable):
+    """
+    Run a function for items concurrently across chats
+    while keeping the order within each chat
+    """
+
+    def __init__(
+            self, function: typing.Callable[[typing.Any], typing.Any],
+            settings: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    ) -> None:
+        """
+        Initialize object
+
+        :param function: Function to call for every item
+        :param settings: Settings for instance (default: None)
+        """
+        if settings is None:
+            settings = {}
+        super(ChatForwarder, self).__init__(settings)
+        self._function = function
+        self._workers: int = settings.get(
+            'forward_workers', min(32, (os.cpu_count() or 1) + 4)
+        )
+        """ Threads forwarding concurrently """
+        self._max_in_flight: int = settings.get(
+            'forward_max_in_flight', self._workers * 4
+        )
+        """ Max items submitted but not yet done (submit blocks) """
+        self._slots = threading.BoundedSemaphore(self._max_in_flight)
+        self._lock = threading.Condition()
+        self._chats: typing.Dict[typing.Any, typing.Deque] = {}
+        """ Pending items per chat (chat present -> being drained) """
+        self._active: int = 0
+        """ Items currently being forwarded """
+        self._executor: typing.Optional[ThreadPoolExecutor] = None
+
+    def start(self) -> None:
+        self._executor = ThreadPoolExecutor(
+            self._workers, thread_name_prefix="telegram-forward"
+        )
+
+    def submit(
+            self, key: typing.Any, item: typing.Any,
+            timeout: typing.Optional[float] = None,
+    ) -> bool:
+        """
+        Queue item for forwarding after all earlier items of the same chat
+
+        :param key: Chat key
+        :param item: Item to forward
+        :param timeout: Max time to wait for a free slot (None -> no limit)
+        :return: Item was queued
+        """
+        if not self._executor:
+            raise RuntimeError("Forwarder not running")
+        if not self._slots.acquire(timeout=timeout):
+            return False
+
+        with self._lock:
+            if key in self._chats:
+                self._chats[key].append(item)
+                return True
+            self._chats[key] = deque([item])
+        try:
+            self._executor.submit(self._drain, key)
+        except RuntimeError:
+            # Executor shut down
+            with self._lock:
+                self._chats.pop(key, None)
+            self._slots.release()
+            raise
+        return True
+
+    def _drain(self, key: typing.Any) -> None:
+        while True:
+            with self._lock:
+                queue = self._chats[key]
+                if not queue:
+                    del self._chats[key]
+                    self._lock.notify_all()
+                    return
+                item = queue.popleft()
+                self._active += 1
+            try:
+                self._function(item)
+            except Exception:
+                self.exception("Failed to forward\n{}".format(item))
+            finally:
+                self._slots.release()
+                with self._lock:
+                    self._active -= 1
+                    self._lock.notify_all()
+
+    @property
+    def in_flight(self) -> int:
+        """ Items queued or being forwarded """
+        with self._lock:
+            return self._active + sum(len(q) for q in self._chats.values())
+
+    def stop(self, timeout: typing.Optional[float] = None) -> typing.List:
+        """
+        Stop forwarding and wait for items in progress
+
+        :param timeout: Max time to wait for items in progress
+            (None -> no limit)
+        :return: Items that were not started
+        """
+        pending = []
+
+        with self._lock:
+            for queue in self._chats.values():
+                pending.extend(queue)
+                for _ in range(len(queue)):
+                    self._slots.release()
+                queue.clear()
+            if not self._lock.wait_for(lambda: self._active == 0, timeout):
+                self.warning("{} items still forwarding".format(self._active))
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        return pending
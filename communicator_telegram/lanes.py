@@ -0,0 +1,148 @@
+# -*- coding: UTF-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+__author__ = "d01"
+__email__ = "jungflor@gmail.com"
+__copyright__ = "Copyright (C) 2017-20, Florian JUNG"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__date__ = "2026-10-19"
+# Created: 2026-10-19 11:40
+
+from collections import deque
+import typing
+
+
+LANE_COMMAND = "command"
+LANE_DIRECT = "direct"
+LANE_GROUP = "group"
+LANE_MEDIA = "media"
+
+DEFAULT_LANES: typing.Dict[str, typing.Dict[str, int]] = {
+    LANE_COMMAND: {'weight': 4, 'batch': 20},
+    LANE_DIRECT: {'weight': 2, 'batch': 20},
+    LANE_GROUP: {'weight': 1, 'batch': 10},
+    LANE_MEDIA: {'weight': 1, 'batch': 5},
+}
+""" Lane settings (batch <= 0 -> no limit) """
+
+
+class PriorityLanes(object):
+    """ Weighted fair selection of queued messages """
+
+    def __init__(
+            self,
+            settings: typing.Optional[
+                typing.Dict[str, typing.Dict[str, int]]
+            ] = None,
+    ) -> None:
+        """
+        Initialize object
+
+        :param settings: Weight and batch limit per lane
+            (merged with DEFAULT_LANES)
+        """
+        if settings is None:
+            settings = {}
+        self.lanes: typing.Dict[str, typing.Dict[str, int]] = {}
+
+        for lane, default in DEFAULT_LANES.items():
+            conf = dict(default)
+            conf.update(settings.get(lane) or {})
+            if conf['weight'] < 1:
+                raise ValueError("Lane {} needs a weight > 0".format(lane))
+            self.lanes[lane] = conf
+        self.order: typing.List[str] = sorted(
+            self.lanes, key=lambda k: -self.lanes[k]['weight']
+        )
+        """ Lanes by descending weight """
+
+    @staticmethod
+    def classify(msg: typing.Dict[str, typing.Any], command: bool) -> str:
+        """
+        Get lane for message
+
+        :param msg: Parsed message
+        :param command: Message is from command queue
+        :return: Lane
+        """
+        if command:
+            return LANE_COMMAND
+        if msg.get('photo') or msg.get('location'):
+            return LANE_MEDIA
+        if (msg.get('chat') or {}).get('type', "private") != "private":
+            return LANE_GROUP
+        return LANE_DIRECT
+
+    @staticmethod
+    def chat_key(msg: typing.Dict[str, typing.Any]) -> typing.Any:
+        """
+        Get chat of message (user for messages without chat)
+
+        :param msg: Parsed message
+        :return: Chat or user id
+        """
+        return (msg.get('chat') or msg.get('user') or {}).get('id')
+
+    def select(
+            self,
+            commands: typing.List[typing.Dict[str, typing.Any]],
+            texts: typing.List[typing.Dict[str, typing.Any]],
+    ) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        Select next batch of messages to forward
+
+        Lanes are drained round robin, taking up to weight messages per
+        round, until every lane is empty or at its batch limit.
+        Order within a lane is kept. Texts of a chat keep their order
+        across lanes (a lane waits while an earlier message of the same
+        chat is pending in another lane), only commands go ahead.
+
+        :param commands: Queued commands
+        :param texts: Queued texts
+        :return: Messages in forwarding order
+        """
+        pending: typing.Dict[str, typing.Deque] = {
+            lane: deque() for lane in self.lanes
+        }
+
+        for msg in commands:
+            pending[LANE_COMMAND].append(msg)
+        # Pending texts per chat in queue order
+        by_chat: typing.Dict[typing.Any, typing.Deque] = {}
+
+        for msg in texts:
+            pending[self.classify(msg, False)].append(msg)
+            by_chat.setdefault(self.chat_key(msg), deque()).append(msg)
+
+        taken = {lane: 0 for lane in self.lanes}
+        result = []
+        progress = True
+
+        while progress:
+            progress = False
+
+            for lane in self.order:
+                conf = self.lanes[lane]
+                n = min(conf['weight'], len(pending[lane]))
+                if conf['batch'] > 0:
+                    n = min(n, conf['batch'] - taken[lane])
+                took = 0
+
+                while took < n:
+                    msg = pending[lane][0]
+                    if lane != LANE_COMMAND:
+                        chat = by_chat[self.chat_key(msg)]
+                        if chat[0] is not msg:
+                            # Earlier message of chat still pending
+                            break
+                        chat.popleft()
+                    result.append(pending[lane].popleft())
+                    took += 1
+                if took:
+                    taken[lane] += took
+                    progress = True
+        return result
@@ -0,0 +1,214 @@
+# -*- coding: UTF-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+__author__ = "d01"
+__email__ = "jungflor@gmail.com"
+__copyright__ = "Copyright (C) 2017-20, Florian JUNG"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__date__ = "2026-10-19"
+# Created: 2026-10-19 17:05
+
+from collections import Counter
+from contextlib import contextmanager
+import datetime
+import os
+import sys
+import threading
+import time
+import typing
+
+from flotils import Logable
+
+
+THREAD_SUBSYSTEMS: typing.Tuple[typing.Tuple[str, str], ...] = (
+    (":dispatcher", "dispatcher"),
+    (":worker:", "dispatcher-worker"),
+    (":updater", "polling"),
+    ("telegram-watcher", "watcher"),
+    ("telegram-forward", "forward"),
+    ("telegram-media", "media"),
+)
+""" Thread name part -> subsystem (for threads without explicit tag) """
+
+_tags: typing.Dict[int, str] = {}
+""" Thread ident -> subsystem """
+
+
+def tag_thread(tag: str) -> None:
+    """
+    Set subsystem of current thread
+
+    :param tag: Subsystem
+    """
+    _tags[threading.get_ident()] = tag
+
+
+@contextmanager
+def tagged(tag: str):
+    """
+    Set subsystem of current thread for the duration of the block
+
+    :param tag: Subsystem
+    """
+    ident = threading.get_ident()
+    previous = _tags.get(ident)
+    _tags[ident] = tag
+    try:
+        yield
+    finally:
+        if previous is None:
+            _tags.pop(ident, None)
+        else:
+            _tags[ident] = previous
+
+
+def get_subsystem(ident: int, name: str) -> str:
+    tag = _tags.get(ident)
+    if tag:
+        return tag
+    for part, subsystem in THREAD_SUBSYSTEMS:
+        if part in name:
+            return subsystem
+    return "other"
+
+
+class SamplingProfiler(Logable):
+    """
+    Periodically sample stacks of all threads and aggregate them
+    as folded stacks (subsystem;thread;frames... count)
+    """
+
+    def __init__(
+            self, path: typing.Optional[str],
+            settings: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    ) -> None:
+        """
+        Initialize object
+
+        :param path: Directory to write profiles to
+        :param settings: Settings for instance (default: None)
+        """
+        if settings is None:
+            settings = {}
+        super(SamplingProfiler, self).__init__(settings)
+        self._path = path
+        self._interval: float = settings.get('profile_interval', 0.01)
+        """ Default time between samples """
+        self._max_duration: float = settings.get('profile_max_duration', 600.0)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+        self._stacks: typing.Counter[str] = Counter()
+        self._samples: int = 0
+        self._file: typing.Optional[str] = None
+        """ Profile of current/last run """
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _sample(self, own: int) -> None:
+        names = {t.ident: t.name for t in threading.enumerate()}
+
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            name = names.get(ident, str(ident))
+            frames = []
+
+            while frame is not None:
+                code = frame.f_code
+                frames.append("{}:{}".format(
+                    os.path.basename(code.co_filename), code.co_name
+                ))
+                frame = frame.f_back
+            frames.append(name)
+            frames.append(get_subsystem(ident, name))
+            self._stacks[";".join(reversed(frames))] += 1
+
+    def _run(self, duration: float, interval: float) -> None:
+        own = threading.get_ident()
+        end = time.monotonic() + duration
+
+        while time.monotonic() < end:
+            self._sample(own)
+            self._samples += 1
+            if self._stop.wait(interval):
+                break
+        self._dump()
+
+    def _dump(self) -> None:
+        with self._lock:
+            stacks = self._stacks
+            self._stacks = Counter()
+            path = self._file
+        try:
+            with open(path, "w") as f:
+                for stack, count in stacks.most_common():
+                    f.write("{} {}\n".format(stack, count))
+        except Exception:
+            self.exception("Failed to write profile {}".format(path))
+        else:
+            self.info("Wrote profile ({} samples) to {}".format(
+                self._samples, path
+            ))
+
+    def start(
+            self, duration: float, interval: typing.Optional[float] = None
+    ) -> str:
+        """
+        Start sampling in background
+
+        :param duration: Seconds to sample (capped by profile_max_duration)
+        :param interval: Seconds between samples (None -> default)
+        :return: Path profile will be written to
+        :raises RuntimeError: Already running or no path
+        """
+        if not self._path:
+            raise RuntimeError("No profile path (cache_path) set")
+        with self._lock:
+            if self.is_running:
+                raise RuntimeError("Profiler already running")
+            self._stop.clear()
+            self._stacks = Counter()
+            self._samples = 0
+            self._file = os.path.join(
+                self._path, "profile-{}.folded".format(
+                    datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+                )
+            )
+            self._thread = threading.Thread(
+                target=self._run, name="telegram-profiler",
+                args=(
+                    min(duration, self._max_duration),
+                    interval or self._interval,
+                )
+            )
+            self._thread.daemon = True
+            self._thread.start()
+        self.info("Profiling for {}s".format(duration))
+        return self._file
+
+    def stop(self, timeout: typing.Optional[float] = 5.0) -> typing.Optional[str]:
+        """
+        Stop sampling early and write profile
+
+        :param timeout: Max time to wait for profile to be written
+        :return: Path of profile (None if never started)
+        """
+        self._stop.set()
+        thread = self._thread
+        if thread:
+            thread.join(timeout)
+        return self._file
+
+    def get_status(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'running': self.is_running,
+            'samples': self._samples,
+            'file': self._file,
+        }
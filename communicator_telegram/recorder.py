@@ -0,0 +1,156 @@
+# -*- coding: UTF-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+__author__ = "d01"
+__email__ = "jungflor@gmail.com"
+__copyright__ = "Copyright (C) 2017-20, Florian JUNG"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__date__ = "2026-10-19"
+# Created: 2026-10-19 13:50
+
+import gzip
+import json
+import threading
+import time
+import typing
+
+from flotils import Logable
+
+
+MEDIA_KEYS = (
+    "photo", "document", "audio", "video", "voice", "video_note",
+    "sticker", "animation",
+)
+""" Message keys containing files """
+SCRUBBED = "scrubbed"
+
+
+def scrub_media(data: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+    """
+    Replace file ids and thumbnails in update dict (in place)
+
+    Media keys are kept so the same handlers match on replay
+
+    :param data: Update dict
+    :return: Scrubbed update dict
+    """
+    def scrub(obj):
+        if isinstance(obj, list):
+            for o in obj:
+                scrub(o)
+        elif isinstance(obj, dict):
+            for key in ("file_id", "file_unique_id"):
+                if key in obj:
+                    obj[key] = SCRUBBED
+            obj.pop('thumb', None)
+            obj.pop('file_name', None)
+
+    for msg_key in (
+            "message", "edited_message", "channel_post", "edited_channel_post"
+    ):
+        msg = data.get(msg_key)
+        if not msg:
+            continue
+        for key in MEDIA_KEYS:
+            if key in msg:
+                scrub(msg[key])
+    return data
+
+
+def read_recording(
+        path: str
+) -> typing.Iterator[typing.Tuple[float, typing.Dict[str, typing.Any]]]:
+    """
+    Read recorded updates
+
+    Sessions appended by later starts are played back to back
+    (time between them skipped)
+
+    :param path: Recording file
+    :return: Offset since recording start (in seconds) and update dict
+    """
+    # Offset of current session
+    base = 0.0
+    last = 0.0
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            if 's' in rec:
+                # New session (offsets restart at 0)
+                base = last
+                continue
+            last = base + rec['t']
+            yield last, rec['u']
+
+
+class UpdateRecorder(Logable):
+    """ Write raw incoming updates to a gzipped json lines file """
+
+    def __init__(
+            self, path: str, scrub: bool = False,
+            settings: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    ) -> None:
+        """
+        Initialize object
+
+        :param path: File to record to (appended)
+        :param scrub: Remove file ids of media
+        :param settings: Settings for instance (default: None)
+        """
+        if settings is None:
+            settings = {}
+        super(UpdateRecorder, self).__init__(settings)
+        self._path = path
+        self._scrub = scrub
+        self._flush_every: int = settings.get('record_flush_every', 100)
+        self._lock = threading.Lock()
+        self._file = None
+        self._start: float = 0.0
+        self._count: int = 0
+
+    def start(self) -> None:
+        with self._lock:
+            self._file = gzip.open(self._path, "at", encoding="utf-8")
+            self._start = time.monotonic()
+            self._count = 0
+            # Session marker -> offsets of appended sessions get rebased
+            self._file.write(json.dumps({'s': time.time()}))
+            self._file.write("\n")
+        self.info("Recording updates to {}".format(self._path))
+
+    def record(self, data: typing.Dict[str, typing.Any]) -> None:
+        """
+        Record one update
+
+        :param data: Update dict
+        """
+        if self._scrub:
+            scrub_media(data)
+        offset = time.monotonic() - self._start
+        line = json.dumps(
+            {'t': round(offset, 4), 'u': data}, separators=(",", ":")
+        )
+
+        with self._lock:
+            if not self._file:
+                return
+            self._file.write(line)
+            self._file.write("\n")
+            self._count += 1
+            if self._count % self._flush_every == 0:
+                self._file.flush()
+
+    def stop(self) -> None:
+        with self._lock:
+            if not self._file:
+                return
+            self._file.close()
+            self._file = None
+        self.info("Recorded {} updates".format(self._count))
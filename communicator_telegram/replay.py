@@ -0,0 +1,206 @@
+# -*- coding: UTF-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+__author__ = "d01"
+__email__ = "jungflor@gmail.com"
+__copyright__ = "Copyright (C) 2017-20, Florian JUNG"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__date__ = "2026-10-19"
+# Created: 2026-10-19 14:20
+
+import threading
+import time
+import typing
+
+import telegram
+from telegram.utils.request import Request
+
+from .recorder import read_recording
+from .telegram import TelegramClient
+
+
+class ReplayFile(object):
+    """ Downloaded file without network """
+
+    def __init__(self, file_id: str) -> None:
+        self.file_id = file_id
+
+    def download(self, custom_path=None, out=None, timeout=None):
+        out.write(b"replay")
+        return out
+
+
+class ReplayBot(telegram.Bot):
+    """ Bot answering api calls locally """
+
+    def __init__(self) -> None:
+        # Never used for api calls, sized to keep the updater quiet
+        super(ReplayBot, self).__init__(
+            "000:replay", request=Request(con_pool_size=32)
+        )
+        self.bot = telegram.User(0, "replay", True, username="replay_bot")
+        self.sent: int = 0
+        self._lock = threading.Lock()
+
+    def get_file(self, file_id, timeout=None, **kwargs):
+        return ReplayFile(file_id)
+
+    def _sent(self) -> None:
+        with self._lock:
+            self.sent += 1
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        self._sent()
+
+    def send_photo(self, chat_id, photo, *args, **kwargs):
+        self._sent()
+
+
+def percentile(values: typing.List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def replay(
+        client: TelegramClient, path: str, speed: float = 1.0,
+        forward_rate: float = 0.0, report_every: float = 5.0,
+) -> typing.Dict[str, typing.Any]:
+    """
+    Feed recorded updates into client handlers
+
+    :param client: Client with handlers set up
+    :param path: Recording file
+    :param speed: Time scale (2.0 -> twice as fast, 0 -> max speed)
+    :param forward_rate: Messages per second taken out of the queues
+        (simulated forwarding, 0 -> none)
+    :param report_every: Seconds between progress reports
+    :return: Replay statistics
+    """
+    bot = client.bot
+    latencies = []
+    max_queued = 0
+    done = threading.Event()
+    forwarded = [0]
+
+    def forward():
+        while not done.is_set():
+            msgs = client.get_batch()
+            ids = [msg['update_id'] for msg in msgs]
+            client.delete_commands(ids)
+            client.delete_texts(ids)
+            forwarded[0] += len(msgs)
+            done.wait(max(len(msgs), 1) / forward_rate)
+
+    if forward_rate > 0:
+        a_thread = threading.Thread(target=forward, name="replay-forward")
+        a_thread.daemon = True
+        a_thread.start()
+
+    start = last_report = time.monotonic()
+
+    for offset, data in read_recording(path):
+        if speed > 0:
+            delay = offset / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        update = telegram.Update.de_json(data, bot)
+        t = time.monotonic()
+        client.process_update(update)
+        now = time.monotonic()
+        latencies.append(now - t)
+        max_queued = max(max_queued, sum(client.get_queue_sizes()))
+
+        if report_every and now - last_report >= report_every:
+            last_report = now
+            print("{:8.1f}s {:7d} updates {:8.1f}/s queued {}|{}".format(
+                now - start, len(latencies), len(latencies) / (now - start),
+                *client.get_queue_sizes()
+            ))
+    # Queue albums still waiting for more updates
+    client.flush_media_groups()
+    elapsed = time.monotonic() - start
+    done.set()
+
+    return {
+        'updates': len(latencies),
+        'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'handler_p50': percentile(latencies, 0.5),
+        'handler_p95': percentile(latencies, 0.95),
+        'handler_max': max(latencies) if latencies else 0.0,
+        'queued_max': max_queued,
+        'queued_end': client.get_queue_sizes(),
+        'forwarded': forwarded[0],
+        'rejected': client.get_flood_stats()['rejected'],
+        'sent': bot.sent,
+    }
+
+
+def main():
+    import argparse
+    import logging
+    import logging.config
+
+    from flotils.logable import default_logging_config
+    from flotils.loadable import load_file
+
+    argparser = argparse.ArgumentParser(prog="replay")
+    argparser.add_argument("recording", type=str)
+    argparser.add_argument(
+        "-s", "--settings", type=str, default=None,
+        help="Telegram client settings"
+    )
+    argparser.add_argument(
+        "--speed", type=float, default=1.0,
+        help="Time scale (2 -> twice as fast, 0 -> max speed)"
+    )
+    argparser.add_argument(
+        "--forward-rate", type=float, default=0.0,
+        help="Simulated forwarding in messages per second (0 -> none)"
+    )
+    argparser.add_argument("--report-every", type=float, default=5.0)
+    argparser.add_argument(
+        "--allow-unknown", action="store_true",
+        help="Don't block users without mapping (no rpc lookups offline)"
+    )
+    argparser.add_argument("--debug", action="store_true")
+    args = argparser.parse_args()
+
+    logging.config.dictConfig(default_logging_config)
+    logging.getLogger().setLevel(
+        logging.DEBUG if args.debug else logging.WARNING
+    )
+
+    settings = {}
+    if args.settings:
+        settings.update(load_file(args.settings))
+    # Keep replay side effect free
+    settings.pop('cache_path', None)
+    settings.pop('record_path', None)
+    if args.allow_unknown:
+        settings['block_unknown_users'] = False
+
+    client = TelegramClient(settings, bot=ReplayBot())
+    client.map_load()
+    client.whitelist_load()
+    client.setup_handlers()
+
+    stats = replay(
+        client, args.recording, args.speed, args.forward_rate,
+        args.report_every
+    )
+
+    for key, value in stats.items():
+        if isinstance(value, float):
+            value = round(value, 4)
+        print("{:>12}: {}".format(key, value))
+
+
+if __name__ == "__main__":
+    main()
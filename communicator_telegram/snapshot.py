@@ -0,0 +1,178 @@
+# -*- coding: UTF-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+__author__ = "d01"
+__email__ = "jungflor@gmail.com"
+__copyright__ = "Copyright (C) 2017-20, Florian JUNG"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__date__ = "2026-10-19"
+# Created: 2026-10-19 17:25
+
+import io
+import os
+import pickle
+import struct
+import typing
+import zlib
+
+
+MAGIC = b"TGQC"
+""" Start of every snapshot file """
+VERSION = 1
+""" Current snapshot format version """
+
+KIND_END = 0
+KIND_COMMAND = 1
+KIND_TEXT = 2
+
+FLAG_ZLIB = 0x01
+""" Frame is zlib compressed """
+
+_HEADER = struct.Struct(">4sB")
+""" Magic, version """
+_FRAME = struct.Struct(">BBII")
+""" Kind, flags, number of messages, length of frame data """
+
+_ALLOWED_CLASSES = {
+    ("datetime", "datetime"),
+    ("datetime", "date"),
+    ("datetime", "time"),
+    ("datetime", "timedelta"),
+    ("datetime", "timezone"),
+}
+""" Classes messages may contain (besides builtin types) """
+
+
+class SnapshotError(ValueError):
+    """ File is not a valid snapshot """
+    pass
+
+
+class _Unpickler(pickle.Unpickler):
+    """ Only load plain message data """
+
+    def find_class(self, module, name):
+        if (module, name) not in _ALLOWED_CLASSES:
+            raise SnapshotError(
+                "Forbidden class in snapshot: {}.{}".format(module, name)
+            )
+        return super(_Unpickler, self).find_class(module, name)
+
+
+def is_snapshot(path: str) -> bool:
+    """
+    Check whether file is a snapshot (any version)
+
+    :param path: File to check
+    :return: Is snapshot
+    """
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def write_snapshot(
+        path: str,
+        commands: typing.Sequence[typing.Dict[str, typing.Any]],
+        texts: typing.Sequence[typing.Dict[str, typing.Any]],
+        chunk_size: int = 500, compress: bool = True,
+) -> typing.Tuple[int, int]:
+    """
+    Write queues to snapshot file
+
+    Messages are pickled in frames of chunk_size messages (shared keys
+    and classes are only stored once per frame). Frames not getting
+    smaller by compression (e.g. media) are stored uncompressed.
+    Written to temporary file first and renamed on success, so a crash
+    never leaves a partial snapshot behind
+
+    :param path: Snapshot file
+    :param commands: Queued commands (in order)
+    :param texts: Queued texts (in order)
+    :param chunk_size: Messages per frame
+    :param compress: Try to compress frames
+    :return: Number of commands and texts written
+    """
+    tmp = "{}.tmp".format(path)
+    chunk_size = max(1, chunk_size)
+
+    try:
+        with io.open(tmp, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, VERSION))
+
+            for kind, msgs in ((KIND_COMMAND, commands), (KIND_TEXT, texts)):
+                for i in range(0, len(msgs), chunk_size):
+                    chunk = list(msgs[i:i + chunk_size])
+                    data = pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL)
+                    flags = 0
+                    if compress:
+                        packed = zlib.compress(data, 1)
+                        if len(packed) < len(data) * 0.9:
+                            data = packed
+                            flags |= FLAG_ZLIB
+                    f.write(_FRAME.pack(kind, flags, len(chunk), len(data)))
+                    f.write(data)
+            f.write(_FRAME.pack(KIND_END, 0, 0, 0))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return len(commands), len(texts)
+
+
+def read_snapshot(
+        path: str
+) -> typing.Generator[
+    typing.Tuple[int, typing.List[typing.Dict[str, typing.Any]]], None, None
+]:
+    """
+    Stream message frames from snapshot file
+
+    :param path: Snapshot file
+    :return: Generator of (kind, messages)
+    :raises SnapshotError: Not a snapshot, unknown version or damaged
+    """
+    with io.open(path, "rb") as f:
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise SnapshotError("Snapshot header truncated")
+        magic, version = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise SnapshotError("Not a snapshot")
+        if version != VERSION:
+            raise SnapshotError(
+                "Unsupported snapshot version {}".format(version)
+            )
+
+        while True:
+            frame = f.read(_FRAME.size)
+            if len(frame) < _FRAME.size:
+                raise SnapshotError("Snapshot truncated")
+            kind, flags, count, length = _FRAME.unpack(frame)
+            if kind == KIND_END:
+                return
+            if kind not in (KIND_COMMAND, KIND_TEXT):
+                raise SnapshotError("Unknown frame kind {}".format(kind))
+            data = f.read(length)
+            if len(data) < length:
+                raise SnapshotError("Snapshot truncated")
+            try:
+                if flags & FLAG_ZLIB:
+                    data = zlib.decompress(data)
+                msgs = _Unpickler(io.BytesIO(data)).load()
+            except SnapshotError:
+                raise
+            except Exception as e:
+                raise SnapshotError("Damaged frame: {}".format(e))
+            if not isinstance(msgs, list) or len(msgs) != count:
+                raise SnapshotError("Damaged frame")
+            yield kind, msgs
@@ -12,8 +12,14 @@ __version__ = "0.2.0"
 __date__ = "2020-04-13"
 # Created: 2017-07-07 19:16
 
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from contextlib import contextmanager
 from pprint import pformat
 import datetime
+import os
+import shutil
+import socket
+import sys
 import threading
 import time
 import typing
@@ -24,15 +30,36 @@ from flotils import Loadable, StartStopable
 from six import string_types, text_type
 import telegram
 import telegram.ext
-from telegram.ext import Updater, MessageHandler, Filters
+from telegram.ext import Updater, MessageHandler, TypeHandler, Filters
+from telegram.constants import MAX_MESSAGE_LENGTH
 from telegram.error import TimedOut
 
+from .__version__ import __version__ as module_version
+from .chunking import coalesce
+from .flood import FloodGate
+from .lanes import PriorityLanes
+from .profiler import SamplingProfiler, tagged
+from .recorder import UpdateRecorder
+from .snapshot import (
+    KIND_COMMAND, is_snapshot, read_snapshot, write_snapshot
+)
+from .tracing import Tracer, STAGE_ENQUEUED, STAGE_REPLY, STAGE_SENT
+from .utils import run_parallel, Deadline
+
 
 class TelegramClient(Loadable, StartStopable):
     
     def __init__(
-            self, settings: typing.Optional[typing.Dict[str, typing.Any]] = None
+            self, settings: typing.Optional[typing.Dict[str, typing.Any]] = None,
+            bot: typing.Optional[telegram.Bot] = None,
     ) -> None:
+        """
+        Initialize object
+
+        :param settings: Settings for instance (default: None)
+        :param bot: Use this bot instead of creating one from settings token
+            (default: None)
+        """
         if settings is None:
             settings = {}
         super().__init__(settings)
@@ -43,20 +70,153 @@ class TelegramClient(Loadable, StartStopable):
         self._user_map: typing.Union[typing.Dict[int, str], str] = \
             settings.get('user_map', {})
         """ Map telegram user ids to internal uuids """
-        self._user_whitelist: typing.Optional[str, typing.List[int]] = \
+        self._user_whitelist: typing.Union[None, str, typing.Set[int]] = \
             settings.get('user_whitelist', None)
-        """ TODO """
+        """ Only allowed users (path to load from or ids) """
+        if isinstance(self._user_whitelist, list):
+            self._user_whitelist = set(self._user_whitelist)
+        self._flood = FloodGate(settings)
+        """ Drop floods and blocked users before parsing """
 
-        self._updater = Updater(
-            token=settings['token'], use_context=True,
+        self._workers: int = settings.get("telegram_workers", 4)
+        """ Dispatcher worker threads (only used by run_async handlers) """
+        self._send_concurrency: typing.Optional[int] = settings.get(
+            "send_concurrency", None
         )
+        """ Max concurrent outbound api calls (None -> unlimited) """
+        self._media_workers: int = settings.get("media_download_workers", 4)
+        self._con_pool_size: int = settings.get(
+            "telegram_con_pool_size", "auto"
+        )
+        """ Connection pool size or 'auto' to derive from concurrency """
+        if self._con_pool_size == "auto":
+            # Dispatcher, updater, job queue and main thread (library
+            # default) + album downloads + concurrent sends
+            # (unlimited -> room for a few)
+            self._con_pool_size = 4 + self._media_workers + (
+                self._send_concurrency or 4
+            )
+        self._keep_alive: typing.Optional[int] = settings.get(
+            "telegram_keep_alive", None
+        )
+        """ Tcp keep alive idle time in seconds (None -> library default) """
+        self._timeouts: typing.Dict[str, typing.Optional[float]] = {
+            'connect': settings.get("telegram_connect_timeout", 5.0),
+            'read': settings.get("telegram_read_timeout", 5.0),
+            'text': settings.get("telegram_send_timeout", None),
+            'media': settings.get("telegram_media_timeout", 20.0),
+            'file': settings.get("telegram_file_timeout", None),
+        }
+        """ Timeouts per operation type (None -> request read timeout) """
+        self._allowed_updates: typing.Optional[typing.List[str]] = \
+            settings.get("telegram_allowed_updates", None)
+        """ Update types to receive (None -> derive from handlers) """
+        self._handler_updates: typing.Optional[typing.Set[str]] = set()
+        """ Update types of registered handlers (None -> unknown) """
+        if bot is None:
+            self._updater = Updater(
+                token=settings['token'], use_context=True,
+                workers=self._workers,
+                request_kwargs={
+                    'con_pool_size': self._con_pool_size,
+                    'connect_timeout': self._timeouts['connect'],
+                    'read_timeout': self._timeouts['read'],
+                },
+            )
+        else:
+            self._updater = Updater(
+                bot=bot, use_context=True, workers=self._workers,
+            )
+        self._send_slots: typing.Optional[threading.BoundedSemaphore] = None
+        if self._send_concurrency:
+            self._send_slots = threading.BoundedSemaphore(
+                self._send_concurrency
+            )
+        self._pool_stats_lock = threading.Lock()
+        self._pool_stats: typing.Dict[str, typing.Union[int, float]] = {
+            'checkouts': 0,
+            'overflow': 0,
+            'checkout_total': 0.0,
+            'checkout_max': 0.0,
+        }
+        self._setup_keep_alive()
+        self._setup_pool_stats()
         self._poll_interval: float = settings.get("telegram_poll_interval", 0.0)
         self._timeout: float = settings.get("telegram_timeout", 10.0)
         self._block_unknown: bool = settings.get("block_unknown_users", True)
         self._max_resends: int = settings.get("max_retry_send", 2)
+        self._max_length: int = settings.get(
+            "message_max_length", MAX_MESSAGE_LENGTH
+        )
+        """ Longer texts are split """
+        self._coalesce: bool = settings.get("coalesce_texts", True)
+        """ Merge consecutive texts into one message """
+        self._coalesce_separator: str = settings.get(
+            "coalesce_separator", "\n"
+        )
         self._command_queue: typing.List = []
         self._text_queue: typing.List = []
         self._queue_lock = threading.RLock()
+        self.lanes = PriorityLanes(settings.get('lanes'))
+        """ Forwarding priorities """
+        self._stop_timeout: float = settings.get("stop_timeout", 10.0)
+        """ Max time to stop (drain sends, flush queues) """
+        self.save_reserve: float = settings.get("cache_save_reserve", 2.0)
+        """ Part of stop time kept for saving the cache """
+        self._sends_cond = threading.Condition()
+        self._sends_active: int = 0
+        """ Number of send calls in progress """
+        self._local_commands: typing.Dict[
+            str, typing.Callable[[typing.Dict[str, typing.Any]], typing.Any]
+        ] = {}
+        """ Commands answered directly (not forwarded) """
+        builtin = {
+            'ping': self._command_ping,
+            'version': self._command_version,
+            'status': self._command_status,
+        }
+        for name in settings.get('local_commands', list(builtin)):
+            if name not in builtin:
+                self.warning("Unknown local command '{}' ({})".format(
+                    name, ", ".join(builtin)
+                ))
+                continue
+            self.register_command(name, builtin[name])
+        self._media_window: float = settings.get("media_group_window", 1.0)
+        """ Time to collect updates of an album (0 -> no coalescing) """
+        self._media_groups: typing.Dict[str, typing.Tuple[
+            threading.Timer, typing.List[telegram.Update], float
+        ]] = {}
+        """ Buffered album updates (and receive time) by media group id """
+        self._media_lock = threading.Lock()
+        self._media_executor = ThreadPoolExecutor(
+            self._media_workers, thread_name_prefix="telegram-media"
+        )
+        """ Parse (download) album updates in parallel """
+        self.profiler = SamplingProfiler(
+            os.path.dirname(self._cache_path) if self._cache_path else None,
+            settings
+        )
+        """ On demand profiling (written next to cache) """
+        self.tracer = Tracer(settings)
+        """ Latencies from update to reply """
+        self._recorder: typing.Optional[UpdateRecorder] = None
+        """ Record raw updates (for replay) """
+        if settings.get('record_path'):
+            self._recorder = UpdateRecorder(
+                self.join_path_prefix(settings['record_path']),
+                settings.get('record_scrub_media', True),
+                settings,
+            )
+        self._cache_batch: int = settings.get("cache_replay_batch", 100)
+        """ Cached messages to requeue at once """
+        self._cache_compress: bool = settings.get("cache_compress", True)
+        """ Compress cache snapshot """
+        self._cache_loaded = threading.Event()
+        """ Cache replay done (nothing to replay yet -> set) """
+        self._cache_loaded.set()
+        self._cache_read: bool = False
+        """ Cache was loaded (else saving would overwrite it) """
         self.new_text = threading.Event()
         """ New text in queue """
         self.new_command = threading.Event()
@@ -75,37 +235,236 @@ class TelegramClient(Loadable, StartStopable):
         except:
             self.exception("Threaded execution failed")
 
-    def cache_load(self):
-        if not self._cache_path:
+    def _setup_keep_alive(self) -> None:
+        """
+        Set tcp keep alive idle time on the connection pool
+        (library hardcodes 120s on linux)
+        """
+        if self._keep_alive is None:
+            return
+        if 'linux' not in sys.platform:
+            self.warning("Keep alive tuning only supported on linux")
             return
         try:
-            cache = self.load_settings(self._cache_path)
-            if cache:
-                self._command_queue = cache.get('commands', [])
-                self._text_queue = cache.get('texts', [])
-                self.info(
-                    "Loaded {}|{} messages from cache".format(
-                        len(self._command_queue), len(self._text_queue)
+            pool_kw = self._updater.bot.request._con_pool.connection_pool_kw
+            pool_kw['socket_options'] = [
+                opt
+                for opt in pool_kw['socket_options']
+                if opt[:2] != (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE)
+            ] + [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self._keep_alive)]
+        except (AttributeError, KeyError):
+            self.exception("Failed to set keep alive")
+
+    def _setup_pool_stats(self) -> None:
+        """
+        Record connection checkouts of the request connection pools
+        (time to get a connection and connections opened beyond pool size)
+        """
+        try:
+            manager = self._updater.bot.request._con_pool
+            classes = manager.pool_classes_by_scheme
+        except AttributeError:
+            self.warning("Connection pool not instrumented")
+            return
+        client = self
+
+        def instrument(base):
+            class CheckoutTimedPool(base):
+                def _get_conn(self, timeout=None):
+                    start = time.monotonic()
+                    # No idle connection -> new one beyond pool size
+                    overflow = self.pool is not None and self.pool.empty()
+                    conn = super(CheckoutTimedPool, self)._get_conn(timeout)
+                    client._record_checkout(
+                        time.monotonic() - start, overflow
                     )
-                )
+                    return conn
+            return CheckoutTimedPool
+
+        # Per manager copy, leave library defaults alone
+        manager.pool_classes_by_scheme = {
+            scheme: instrument(cls) for scheme, cls in classes.items()
+        }
+
+    def _record_checkout(self, diff: float, overflow: bool) -> None:
+        with self._pool_stats_lock:
+            self._pool_stats['checkouts'] += 1
+            self._pool_stats['checkout_total'] += diff
+            self._pool_stats['checkout_max'] = max(
+                self._pool_stats['checkout_max'], diff
+            )
+            if overflow:
+                self._pool_stats['overflow'] += 1
+
+    @contextmanager
+    def _send_slot(self):
+        """
+        Acquire an outbound send slot (if send concurrency is limited)
+        """
+        if self._send_slots is None:
+            yield
+            return
+        start = time.monotonic()
+        self._send_slots.acquire()
+        diff = time.monotonic() - start
+
+        if diff > 1.0:
+            self.warning("Waited {}s for send slot".format(round(diff, 2)))
+        try:
+            yield
+        finally:
+            self._send_slots.release()
+
+    def get_pool_stats(self) -> typing.Dict[str, typing.Any]:
+        """
+        Return connection pool settings and checkout statistics
+
+        :return: Pool stats
+        """
+        with self._pool_stats_lock:
+            stats = dict(self._pool_stats)
+        stats['checkout_avg'] = stats['checkout_total'] / stats['checkouts'] \
+            if stats['checkouts'] else 0.0
+        stats['con_pool_size'] = self._con_pool_size
+        stats['send_concurrency'] = self._send_concurrency
+        stats['workers'] = self._workers
+        return stats
+
+    def _replay_cached(
+            self, commands: typing.List[typing.Dict[str, typing.Any]],
+            texts: typing.List[typing.Dict[str, typing.Any]],
+    ) -> None:
+        """
+        Requeue cached messages ahead of messages received since start
+
+        Cached updates are older than live ones (update ids are increasing),
+        so each batch is inserted behind the last older message
+
+        :param commands: Cached commands
+        :param texts: Cached texts
+        """
+        def merge(queue, msgs):
+            if not msgs:
+                return queue
+            last = msgs[-1]['update_id']
+            i = len(queue)
+
+            # Newer messages are at the end (few, compared to cached ones)
+            while i and queue[i - 1]['update_id'] > last:
+                i -= 1
+            return queue[:i] + msgs + queue[i:]
+
+        with self._queue_lock:
+            self._command_queue = merge(self._command_queue, commands)
+            self._text_queue = merge(self._text_queue, texts)
+
+            if self._command_queue:
+                # Got commands
+                self.new_command.set()
+            if self._text_queue:
+                # Got texts
+                self.new_text.set()
+
+    def requeue(self, msgs: typing.List[typing.Dict[str, typing.Any]]) -> None:
+        """
+        Put popped messages back into their queues (e.g. not forwarded)
+
+        :param msgs: Messages to requeue
+        """
+        if not msgs:
+            return
+        msgs = sorted(msgs, key=lambda m: m['update_id'])
+        self._replay_cached(
+            [msg for msg in msgs if 'command' in msg],
+            [msg for msg in msgs if 'command' not in msg],
+        )
+        self.info("Requeued {} messages".format(len(msgs)))
+
+    def _cache_load_snapshot(self) -> typing.Tuple[int, int]:
+        n_commands = n_texts = 0
+
+        # Frames are written in replay batch size
+        for kind, msgs in read_snapshot(self._cache_path):
+            if kind == KIND_COMMAND:
+                self._replay_cached(msgs, [])
+                n_commands += len(msgs)
+            else:
+                self._replay_cached([], msgs)
+                n_texts += len(msgs)
+        return n_commands, n_texts
+
+    def _cache_load_legacy(self) -> typing.Tuple[int, int]:
+        cache = self.load_settings(self._cache_path)
+        if not cache:
+            return 0, 0
+        commands = cache.get('commands', [])
+        texts = cache.get('texts', [])
+        batch = max(1, self._cache_batch)
+
+        for i in range(0, max(len(commands), len(texts)), batch):
+            self._replay_cached(commands[i:i + batch], texts[i:i + batch])
+        # Kept as is, converted by next save
+        return len(commands), len(texts)
+
+    def cache_load(self):
+        if not self._cache_path or not os.path.exists(self._cache_path):
+            self._cache_read = True
+            self._cache_loaded.set()
+            return
+        try:
+            if is_snapshot(self._cache_path):
+                loaded = self._cache_load_snapshot()
+            else:
+                # Settings file written by older versions
+                loaded = self._cache_load_legacy()
+            self.info("Loaded {}|{} messages from cache".format(*loaded))
         except Exception:
             self.exception("Failed to load cache ({})".format(self._cache_path))
+        finally:
+            self._cache_read = True
+            self._cache_loaded.set()
+
+    def cache_save(self, timeout: typing.Optional[float] = None):
+        """
+        Save queued messages to cache
 
-    def cache_save(self):
+        :param timeout: Max time to wait for cache replay to finish
+            (None -> stop_timeout)
+        """
         if not self._cache_path:
             return
+        if timeout is None:
+            timeout = self._stop_timeout
+        if not self._cache_loaded.wait(timeout):
+            # Saving now would overwrite messages not yet replayed
+            self.error("Cache replay still running - not saving cache")
+            return
+        if not self._cache_read:
+            # E.g. start failed before loading
+            self.warning("Cache not loaded - not saving cache")
+            return
+        with self._queue_lock:
+            commands = list(self._command_queue)
+            texts = list(self._text_queue)
         try:
-            self.save_settings(self._cache_path, {
-                'commands': self._command_queue,
-                'texts': self._text_queue
-            })
-            self.info(
-                "Saved {}|{} messages to cache".format(
-                    len(self._command_queue), len(self._text_queue)
+            if os.path.exists(self._cache_path) \
+                    and not is_snapshot(self._cache_path):
+                # Keep settings file of older versions (e.g. for rollback)
+                backup = "{}.bak".format(self._cache_path)
+                shutil.copy2(self._cache_path, backup)
+                self.info(
+                    "Converting cache to snapshot (old kept as {})".format(
+                        backup
+                    )
                 )
-            )
+            self.info("Saved {}|{} messages to cache".format(
+                *write_snapshot(
+                    self._cache_path, commands, texts, self._cache_batch,
+                    self._cache_compress
+                )
+            ))
         except Exception:
-            self.exception("Failed to save cache ({])".format(self._cache_path))
+            self.exception("Failed to save cache ({})".format(self._cache_path))
 
     def map_load(self):
         if isinstance(self._user_map, (string_types, text_type)):
@@ -135,7 +494,7 @@ class TelegramClient(Loadable, StartStopable):
                 self.info(
                     "User whitelist loaded ({} entries)".format(len(ulist))
                 )
-                self._user_whitelist = [int(v) for v in ulist]
+                self._user_whitelist = {int(v) for v in ulist}
             except:
                 self.exception("Failed to load user whitelist from {}".format(
                     path
@@ -144,15 +503,34 @@ class TelegramClient(Loadable, StartStopable):
     def get_user_external(self, user_id):
         return None
 
-    def get_user(self, user_id):
+    def _lookup_user(
+            self, user_id: int
+    ) -> typing.Tuple[typing.Optional[str], bool]:
+        """
+        Look up internal user
+
+        :param user_id: Telegram user id
+        :return: Internal user (None -> unknown) and whether the external
+            lookup answered (False -> failed, e.g. rpc error or no proxy)
+        """
+        answered = True
         try:
             user = self.get_user_external(user_id)
+        except IOError as e:
+            # Expected while external is unavailable (counted as reject)
+            self.debug("User lookup unavailable: {}".format(e))
+            user = None
+            answered = False
         except Exception:
-            self.exception("Failed to get user from external")
+            self.debug("Failed to get user from external", exc_info=True)
             user = None
+            answered = False
         if not user:
             user = self._user_map.get(user_id)
-        return user
+        return user, answered
+
+    def get_user(self, user_id):
+        return self._lookup_user(user_id)[0]
 
     # def _error_handler(self, bot, update, error):
     def _error_handler(
@@ -177,16 +555,74 @@ class TelegramClient(Loadable, StartStopable):
         except telegram.error.TelegramError:
             self.exception("Telegram exception occurred")
 
+    @staticmethod
+    def _describe_user(user: telegram.User) -> str:
+        return "{} (@{})".format(user.id, user.username)
+
+    def _gate(self, update: telegram.Update) -> bool:
+        """
+        Cheap pre parse checks (no rpc, no serialisation)
+
+        :param update: Incoming update
+        :return: Update should be processed
+        """
+        user = update.effective_user
+
+        if not user:
+            self._flood.reject("no user", update.update_id)
+            return False
+        if isinstance(self._user_whitelist, set) \
+                and user.id not in self._user_whitelist:
+            # If whitelist is set -> user must be inside
+            self._flood.reject("not whitelisted", self._describe_user(user))
+            return False
+        chat = update.effective_chat
+        message = update.effective_message
+        group_id = message.media_group_id if message else None
+        if group_id:
+            with self._media_lock:
+                # Album counts once against rate limits
+                counted = group_id in self._media_groups
+        else:
+            counted = False
+        reason = self._flood.check(
+            user.id, chat.id if chat else None, not counted
+        )
+
+        if reason:
+            self._flood.reject(reason, self._describe_user(user))
+            return False
+        return True
+
+    def get_latency_stats(self) -> typing.Dict[str, typing.Any]:
+        """
+        Return latency histograms by stage
+
+        :return: Latency stats
+        """
+        return self.tracer.get_stats()
+
+    def get_flood_stats(self) -> typing.Dict[str, typing.Any]:
+        """
+        Return dropped update statistics
+
+        :return: Flood stats
+        """
+        return self._flood.get_stats()
+
     def _parse_message(
-            self, update: telegram.Update, bot: telegram.Bot
+            self, update: telegram.Update, bot: telegram.Bot,
+            trace: bool = True,
     ) -> typing.Optional[typing.Dict[str, typing.Any]]:
         """
         Parse update and return result
 
         :param update: Update to parse
         :param bot:
+        :param trace: Start latency trace for accepted update
         :return: Parsed result
         """
+        received = time.time()
         result = {}
         user = update.effective_user
         chat = update.effective_chat
@@ -195,21 +631,24 @@ class TelegramClient(Loadable, StartStopable):
 
         if user:
             result['user'] = user.to_dict()
-            if isinstance(self._user_whitelist, list):
-                # If whitelist is list -> user must be inside
-                if not user.id in self._user_whitelist:
-                    self.warning("Blocked not whitelisted user\n{}".format(
-                        result['user']
-                    ))
-                    return None
-
-            result['mapped_user'] = self.get_user(user.id)
+            result['mapped_user'], answered = self._lookup_user(user.id)
             if not result['mapped_user'] and self._block_unknown:
-                self.warning("Blocked unknown user\n{}".format(result['user']))
+                if not answered:
+                    self._flood.reject(
+                        "lookup failed", self._describe_user(user)
+                    )
+                    return None
+                # Skip lookups for further updates of this user for a while
+                self._flood.block_unknown(user.id)
+                self._flood.reject("unknown", self._describe_user(user))
                 return None
         else:
             self.error("No user - blocking")
             return None
+        if trace:
+            result['trace_id'] = self.tracer.start(
+                message.date if message else None, received
+            )
 
         if chat:
             result['chat'] = chat.to_dict()
@@ -231,15 +670,19 @@ class TelegramClient(Loadable, StartStopable):
                     result['timestamp']
                 )
             result['message'] = message.text
+            if message.caption:
+                result['caption'] = message.caption
             if message.location:
                 result['location'] = message.location.to_dict()
             if message.photo:
                 psize = message.photo[-1]
-                file = bot.get_file(psize.file_id)
+                file = bot.get_file(
+                    psize.file_id, timeout=self._timeouts['file']
+                )
                 self.debug(file)
                 bio = BytesIO()
                 bio.name = "image"
-                file.download(out=bio)
+                file.download(out=bio, timeout=self._timeouts['file'])
                 bio.flush()
                 bio.seek(0)
                 result['photo'] = base64.b64encode(bio.read())
@@ -248,9 +691,27 @@ class TelegramClient(Loadable, StartStopable):
             # self.debug(message.parse_entities())
         return result
 
+    def _queue_text(
+            self, result: typing.Dict[str, typing.Any], update: typing.Any
+    ) -> None:
+        with self._queue_lock:
+            if result:
+                self._text_queue.append(result)
+                self.tracer.mark(result.get('trace_id'), STAGE_ENQUEUED)
+                self.new_text.set()
+            else:
+                self.warning("Did not add message\n{}".format(update))
+
     def _text_handler(
             self, update: telegram.Update, context: telegram.ext.CallbackContext
     ):
+        if not self._gate(update):
+            return
+        message = update.effective_message
+
+        if self._media_window and message and message.media_group_id:
+            self._buffer_media_group(update, context.bot)
+            return
         result = self._parse_message(update, context.bot)
 
         if result is None:
@@ -262,12 +723,103 @@ class TelegramClient(Loadable, StartStopable):
         if user_data:
             self.debug("User data: {}".format(pformat(user_data)))
 
-        with self._queue_lock:
+        self._queue_text(result, update)
+
+    def _buffer_media_group(
+            self, update: telegram.Update, bot: telegram.Bot
+    ) -> None:
+        """
+        Collect album updates until the group window passed
+
+        :param update: Update with media group id
+        :param bot: bot
+        """
+        group_id = update.effective_message.media_group_id
+
+        with self._media_lock:
+            if group_id in self._media_groups:
+                self._media_groups[group_id][1].append(update)
+                return
+            timer = threading.Timer(
+                self._media_window, self._thread_wrapper,
+                args=(self._flush_media_group, group_id, bot)
+            )
+            timer.daemon = True
+            self._media_groups[group_id] = (timer, [update], time.time())
+        timer.start()
+
+    def _flush_media_group(
+            self, group_id: str, bot: telegram.Bot,
+            timeout: typing.Optional[float] = None,
+    ) -> None:
+        """
+        Parse buffered album updates (in parallel) and queue them
+        as one message (updates failing to parse are skipped)
+
+        :param group_id: Media group id
+        :param bot: bot
+        :param timeout: Max time to wait for parsing (None -> no limit),
+            updates not parsed in time are skipped
+        """
+        with self._media_lock:
+            timer, updates, received = self._media_groups.pop(
+                group_id, (None, None, None)
+            )
+        if not updates:
+            return
+        timer.cancel()
+        # Album is traced as one message
+        futures = [
+            self._media_executor.submit(self._parse_message, u, bot, False)
+            for u in updates
+        ]
+        done, not_done = wait_futures(futures, timeout)
+        if not_done:
+            self.warning("Skipped {} album updates not parsed in time".format(
+                len(not_done)
+            ))
+        results = []
+
+        for future in futures:
+            if future not in done:
+                continue
+            try:
+                result = future.result()
+            except Exception:
+                self.exception("Failed to parse album update")
+                continue
             if result:
-                self._text_queue.append(result)
-                self.new_text.set()
-            else:
-                self.warning("Did not add message\n{}".format(update))
+                results.append(result)
+
+        if not results:
+            # Blocked user
+            return
+        results.sort(key=lambda r: r['message_id'])
+        result = results[0]
+        result['media_group_id'] = group_id
+        result['update_ids'] = [r['update_id'] for r in results]
+        result['photos'] = [r['photo'] for r in results if r.get('photo')]
+        result['trace_id'] = self.tracer.start(
+            updates[0].effective_message.date, received
+        )
+        # Album caption is only set on one of the updates
+        caption = next((r['caption'] for r in results if r.get('caption')), None)
+        if caption:
+            result['caption'] = caption
+        self.debug("Combined {} album updates".format(len(results)))
+        self._queue_text(result, updates)
+
+    def flush_media_groups(self, timeout: typing.Optional[float] = None) -> None:
+        """
+        Queue all buffered albums now
+
+        :param timeout: Max time to parse albums (None -> no limit)
+        """
+        deadline = Deadline(timeout)
+        with self._media_lock:
+            pending = list(self._media_groups)
+        for group_id in pending:
+            self._flush_media_group(group_id, self.bot, deadline.remaining())
 
     def _command_handler(
             self, update: telegram.Update, context: telegram.ext.CallbackContext
@@ -278,6 +830,8 @@ class TelegramClient(Loadable, StartStopable):
         :param bot: bot
         :param update: Message
         """
+        if not self._gate(update):
+            return
         result = self._parse_message(update, context.bot)
 
         if result is None:
@@ -289,13 +843,104 @@ class TelegramClient(Loadable, StartStopable):
             result['command'] = parts[0]
             result['args'] = " ".join(parts[1:])
 
+            if self._run_local_command(result):
+                return
+
         with self._queue_lock:
             if result:
                 self._command_queue.append(result)
+                self.tracer.mark(result.get('trace_id'), STAGE_ENQUEUED)
                 self.new_command.set()
             else:
                 self.warning("Did not add command\n{}".format(update))
 
+    def register_command(
+            self, name: str,
+            handler: typing.Callable[[typing.Dict[str, typing.Any]], typing.Any],
+    ) -> None:
+        """
+        Answer command locally instead of forwarding it
+
+        The handler gets the parsed command and returns the reply
+        (str, dict or list as accepted by send()) or None to forward
+        the command as usual.
+
+        :param name: Command name (without /)
+        :param handler: Command handler
+        """
+        self._local_commands[name.lower()] = handler
+
+    def unregister_command(self, name: str) -> None:
+        self._local_commands.pop(name.lower(), None)
+
+    def _run_local_command(self, result: typing.Dict[str, typing.Any]) -> bool:
+        """
+        Answer command if registered locally
+
+        :param result: Parsed command
+        :return: Command was answered
+        """
+        name, _, target = result['command'].partition("@")
+        handler = self._local_commands.get(name.lower())
+
+        if not handler:
+            return False
+        if target:
+            # Cached bot user (property would also fetch bot commands)
+            me = self.bot.bot or self.bot.get_me()
+            if target != me.username:
+                # Addressed to another bot
+                return False
+        try:
+            answer = handler(result)
+        except Exception:
+            self.exception("Local command {} failed".format(name))
+            return False
+        if answer is None:
+            return False
+        to = (result.get('chat') or result['user'])['id']
+        self.tracer.mark(result.get('trace_id'), STAGE_REPLY)
+        self.reply(to, answer, result.get('message_id'))
+        self.tracer.mark(result.get('trace_id'), STAGE_SENT)
+        return True
+
+    def _command_ping(self, result: typing.Dict[str, typing.Any]) -> str:
+        return "pong"
+
+    def _command_version(self, result: typing.Dict[str, typing.Any]) -> str:
+        return module_version
+
+    def _command_status(self, result: typing.Dict[str, typing.Any]) -> str:
+        commands, texts = self.get_queue_sizes()
+        pool = self.get_pool_stats()
+        return "Running {}\nQueued: {} commands, {} texts\n" \
+            "Pool overflow: {} (checkout avg {}s)\nDropped: {}".format(
+                module_version, commands, texts,
+                pool['overflow'], round(pool['checkout_avg'], 3),
+                self._flood.get_stats()['rejected'],
+            )
+
+    @property
+    def bot(self) -> telegram.Bot:
+        return self._updater.bot
+
+    def process_update(self, update: telegram.Update) -> None:
+        """
+        Run update through handlers (as if received)
+
+        :param update: Update to process
+        """
+        self._updater.dispatcher.process_update(update)
+
+    def get_queue_sizes(self) -> typing.Tuple[int, int]:
+        """
+        Return number of queued messages
+
+        :return: Commands and texts in queue
+        """
+        with self._queue_lock:
+            return len(self._command_queue), len(self._text_queue)
+
     def get_commands(self) -> typing.List[typing.Dict[str, typing.Any]]:
         """
         Return all received commands
@@ -322,6 +967,15 @@ class TelegramClient(Loadable, StartStopable):
             if len(self._command_queue) == 0:
                 self.new_command.clear()
 
+    def get_batch(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """
+        Return next commands and texts to forward (by lane priority)
+
+        :return: Rx messages
+        """
+        with self._queue_lock:
+            return self.lanes.select(self._command_queue, self._text_queue)
+
     def get_texts(self) -> typing.List[typing.Dict[str, typing.Any]]:
         """
         Return all received texts
@@ -354,6 +1008,28 @@ class TelegramClient(Loadable, StartStopable):
             to: typing.Union[str, int],
             text: typing.Union[str, typing.List[typing.Union[str, dict]], dict],
             reply_to_message_id=None, silent: bool = False, tries: int = 0,
+    ) -> None:
+        if not isinstance(text, list):
+            text = [text]
+        text = coalesce(
+            text, self._max_length, self._coalesce_separator, self._coalesce
+        )
+
+        with self._sends_cond:
+            self._sends_active += 1
+        try:
+            with tagged("send"):
+                return self._send(to, text, reply_to_message_id, silent, tries)
+        finally:
+            with self._sends_cond:
+                self._sends_active -= 1
+                self._sends_cond.notify_all()
+
+    def _send(
+            self,
+            to: typing.Union[str, int],
+            text: typing.Union[str, typing.List[typing.Union[str, dict]], dict],
+            reply_to_message_id=None, silent: bool = False, tries: int = 0,
     ) -> None:
         inp_list = text
 
@@ -373,30 +1049,37 @@ class TelegramClient(Loadable, StartStopable):
                     self.debug("Not b64")
                 else:
                     try:
-                        self._updater.bot.send_photo(
-                            to, bio, reply_to_message_id=reply_to_message_id
-                        )
+                        with self._send_slot():
+                            self._updater.bot.send_photo(
+                                to, bio,
+                                reply_to_message_id=reply_to_message_id,
+                                timeout=self._timeouts['media'],
+                            )
                         continue
                     except TimedOut:
                         if tries >= self._max_resends:
                             raise
                         self.warning("Send timed out, retrying #{}..".format(tries))
-                        return self.send(
+                        return self._send(
                             to, inp_list[i:], reply_to_message_id, silent, tries + 1
                         )
             if text:
                 text = "{}".format(text)
+            if not text:
+                continue
 
             try:
-                self._updater.bot.send_message(
-                    to, text, reply_to_message_id=reply_to_message_id,
-                    disable_notification=silent
-                )
+                with self._send_slot():
+                    self._updater.bot.send_message(
+                        to, text, reply_to_message_id=reply_to_message_id,
+                        disable_notification=silent,
+                        timeout=self._timeouts['text'],
+                    )
             except TimedOut:
                 if tries >= self._max_resends:
                     raise
                 self.warning("Send timed out, retrying #{}..".format(tries))
-                return self.send(
+                return self._send(
                     to, inp_list[i:], reply_to_message_id, silent, tries + 1
                 )
 
@@ -408,47 +1091,162 @@ class TelegramClient(Loadable, StartStopable):
     ):
         self.send(to, text, reply_to_message_id, silent)
 
-    def start(self, blocking: bool = False):
-        self.debug("()")
-        self.cache_load()
+    def _record_handler(
+            self, update: telegram.Update, context: telegram.ext.CallbackContext
+    ) -> None:
+        if self._recorder:
+            self._recorder.record(update.to_dict())
 
-        if self._command_queue:
-            # Got commands
-            self.new_command.set()
-        if self._text_queue:
-            # Got commands
-            self.new_text.set()
+    def _add_handler(
+            self, handler: telegram.ext.Handler,
+            update_types: typing.Optional[typing.Iterable[str]],
+            group: int = 0,
+    ) -> None:
+        """
+        Register handler and remember which update types it needs
 
-        self.map_load()
-        self.whitelist_load()
+        :param handler: Handler to add
+        :param update_types: Update types handled (None -> all)
+        :param group: Dispatcher group
+        """
+        self._updater.dispatcher.add_handler(handler, group=group)
+        if update_types is None:
+            self._handler_updates = None
+        elif self._handler_updates is not None:
+            self._handler_updates.update(update_types)
+
+    def get_allowed_updates(self) -> typing.Optional[typing.List[str]]:
+        """
+        Update types to request from telegram
+
+        :return: Configured or derived from handlers (None -> all)
+        """
+        if self._allowed_updates is not None:
+            return self._allowed_updates
+        if self._handler_updates is None:
+            return None
+        return sorted(self._handler_updates)
+
+    def setup_handlers(self) -> None:
+        """
+        Setup telegram callbacks
+        """
+        # Channel posts have no user and would be blocked anyway
+        message_updates = ("message", "edited_message")
 
-        # Setup telegram callbacks
         self._updater.dispatcher.add_error_handler(self._error_handler)
-        self._updater.dispatcher.add_handler(MessageHandler(
+        if self._recorder:
+            # Separate group -> runs before and independent of the others
+            # Records whatever is received -> no own update types
+            self._add_handler(
+                TypeHandler(telegram.Update, self._record_handler), (),
+                group=-1
+            )
+        self._add_handler(MessageHandler(
             Filters.command, self._command_handler
-        ))
-        self._updater.dispatcher.add_handler(MessageHandler(
+        ), message_updates)
+        self._add_handler(MessageHandler(
             Filters.text, self._text_handler,
-        ))
-        self._updater.dispatcher.add_handler(MessageHandler(
+        ), message_updates)
+        self._add_handler(MessageHandler(
             Filters.location, self._text_handler,
-        ))
-        self._updater.dispatcher.add_handler(MessageHandler(
+        ), message_updates)
+        self._add_handler(MessageHandler(
             Filters.photo, self._text_handler,
-        ))
+        ), message_updates)
+
+    def start(self, blocking: bool = False):
+        self.debug("()")
+        # Whitelist and mappings need to be ready before the first update
+        errors = run_parallel([
+            ("telegram-map-load", self.map_load),
+            ("telegram-whitelist-load", self.whitelist_load),
+        ])
 
+        if errors:
+            raise list(errors.values())[0]
+
+        if self._recorder:
+            self._recorder.start()
+        self.setup_handlers()
+        allowed_updates = self.get_allowed_updates()
+        self.debug("Allowed updates: {}".format(allowed_updates))
         self._updater.start_polling(
-            poll_interval=self._poll_interval, timeout=self._timeout
+            poll_interval=self._poll_interval, timeout=self._timeout,
+            allowed_updates=allowed_updates,
+        )
+
+        # Replay cache while already receiving
+        self._cache_loaded.clear()
+        a_thread = threading.Thread(
+            target=self._thread_wrapper, args=(self.cache_load,),
+            name="telegram-cache-load"
         )
+        a_thread.daemon = True
+        a_thread.start()
+
         super(TelegramClient, self).start(blocking)
 
-    def stop(self):
+    def stop_ingress(self, timeout: typing.Optional[float] = None) -> bool:
+        """
+        Stop receiving updates
+
+        The updater is stopped in the background since joining the polling
+        thread can take up to a full long poll. Only the dispatcher needs to
+        be done so no more messages get queued.
+
+        :param timeout: Max time to wait for the dispatcher (None -> no limit)
+        :return: Dispatcher stopped in time
+        """
+        a_thread = threading.Thread(
+            target=self._thread_wrapper, args=(self._updater.stop,),
+            name="telegram-updater-stop"
+        )
+        a_thread.daemon = True
+        a_thread.start()
+        deadline = Deadline(timeout)
+
+        while self._updater.dispatcher.running and not deadline.expired:
+            a_thread.join(min(0.05, deadline.remaining() or 0.05))
+        if self._updater.dispatcher.running:
+            self.warning("Dispatcher still running")
+            return False
+        self.flush_media_groups(deadline.remaining())
+        return True
+
+    def drain_sends(self, timeout: typing.Optional[float] = None) -> bool:
+        """
+        Wait for outgoing messages in progress
+
+        :param timeout: Max time to wait (None -> no limit)
+        :return: All sends finished in time
+        """
+        with self._sends_cond:
+            done = self._sends_cond.wait_for(
+                lambda: self._sends_active == 0, timeout
+            )
+            if not done:
+                self.warning("{} sends still in progress".format(
+                    self._sends_active
+                ))
+            return done
+
+    def stop(self, timeout: typing.Optional[float] = None):
+        """
+        Stop receiving, wait for outgoing messages and save queues
+
+        :param timeout: Max time to stop (None -> stop_timeout),
+            the last save_reserve seconds are kept for saving the cache
+        """
         self.debug("()")
+        if timeout is None:
+            timeout = self._stop_timeout
+        deadline = Deadline(timeout)
+        drain = Deadline(max(0.0, timeout - self.save_reserve))
         super().stop()
-        self.cache_save()
-        # Keeps hanging???
-        try:
-            self._updater.stop()
-        except Exception:
-            self.exception("Failed to stop updater")
-        self.cache_save()
+        self.stop_ingress(drain.remaining())
+        if self._recorder:
+            self._recorder.stop()
+        self.drain_sends(drain.remaining())
+        # No more incoming -> flush once
+        self.cache_save(deadline.remaining())
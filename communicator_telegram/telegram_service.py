@@ -24,6 +24,7 @@ from flotils import get_logger
 
 from .__version__ import __version__ as module_version
 from .telegram import TelegramClient
+from .tracing import STAGE_FORWARDED, STAGE_REPLY, STAGE_SENT
 
 
 logger = get_logger()
@@ -55,12 +56,36 @@ class TelegramDependency(DependencyProvider):
 
 class StandaloneTelegramService(StandaloneCommunicatorService):
     name = "service_communicator_telegram"
-    allowed = ["status", "version", "say", "send", "send_user"]
+    allowed = [
+        "status", "version", "say", "send", "send_user", "pool_stats",
+        "flood_stats", "latency_stats",
+        "profile_start", "profile_stop", "profile_status",
+    ]
     telegram: TelegramClient = None
 
     def version(self) -> str:
         return module_version
 
+    def pool_stats(self) -> typing.Dict[str, typing.Any]:
+        return self.telegram.get_pool_stats()
+
+    def flood_stats(self) -> typing.Dict[str, typing.Any]:
+        return self.telegram.get_flood_stats()
+
+    def latency_stats(self) -> typing.Dict[str, typing.Any]:
+        return self.telegram.get_latency_stats()
+
+    def profile_start(
+            self, seconds: float = 30.0, interval: typing.Optional[float] = None
+    ) -> str:
+        return self.telegram.profiler.start(seconds, interval)
+
+    def profile_stop(self) -> typing.Optional[str]:
+        return self.telegram.profiler.stop()
+
+    def profile_status(self) -> typing.Dict[str, typing.Any]:
+        return self.telegram.profiler.get_status()
+
     def send(
             self,
             to: typing.Union[str, int],
@@ -101,7 +126,10 @@ class StandaloneTelegramService(StandaloneCommunicatorService):
                 to = self.get_user(meta)
             text = msg.result
         if text and to:
+            trace_id = meta.get('trace_id')
+            self.telegram.tracer.mark(trace_id, STAGE_REPLY)
             self.telegram.send(to, text, reply)
+            self.telegram.tracer.mark(trace_id, STAGE_SENT)
 
     def pop_commands(self) -> typing.List[typing.Dict[str, typing.Any]]:
         msgs = self.telegram.get_commands()
@@ -113,6 +141,29 @@ class StandaloneTelegramService(StandaloneCommunicatorService):
         self.telegram.delete_texts([msg['update_id'] for msg in msgs])
         return msgs
 
+    def pop_batch(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        msgs = self.telegram.get_batch()
+        ids = [msg['update_id'] for msg in msgs]
+        self.telegram.delete_commands(ids)
+        self.telegram.delete_texts(ids)
+        return msgs
+
+    def forward(self, t_msg: typing.Dict[str, typing.Any]) -> None:
+        """
+        Forward received message to framework
+
+        :param t_msg: Parsed message
+        """
+        im = None
+
+        try:
+            im = self.to_input_message(t_msg)
+            self.communicate(im)
+        except:
+            logger.exception("Failed to communicate message\n{}".format(im))
+        else:
+            self.telegram.tracer.mark(t_msg.get('trace_id'), STAGE_FORWARDED)
+
     def to_input_message(
             self, t_msg: typing.Dict[str, typing.Any]
     ) -> alexander_fw.dto.InputMessage:
@@ -133,24 +184,10 @@ class TelegramService(CommunicatorService, StandaloneTelegramService):
 
     @timer(interval=1)
     def _timer_msgs_emit(self):
-        cmds = self.pop_commands()
-
-        for cmd in cmds:
-            im = None
-
-            try:
-                im = self.to_input_message(cmd)
-                self.communicate(im)
-            except:
-                logger.exception("Failed to communicate message\n{}".format(im))
-
-        txts = self.pop_texts()
-
-        for txt in txts:
-            im = None
+        msgs = self.pop_batch()
 
-            try:
-                im = self.to_input_message(txt)
-                self.communicate(im)
-            except:
-                logger.exception("Failed to communicate message\n{}".format(im))
+        while msgs:
+            for msg in msgs:
+                self.forward(msg)
+            # Re-check lanes -> new commands get ahead of remaining texts
+            msgs = self.pop_batch()
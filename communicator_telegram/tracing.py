@@ -0,0 +1,189 @@
+# -*- coding: UTF-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+__author__ = "d01"
+__email__ = "jungflor@gmail.com"
+__copyright__ = "Copyright (C) 2017-20, Florian JUNG"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__date__ = "2026-10-19"
+# Created: 2026-10-19 16:30
+
+from bisect import bisect_left
+from collections import OrderedDict
+import datetime
+import threading
+import time
+import typing
+import uuid
+
+
+STAGE_RECEIVED = "received"
+STAGE_ENQUEUED = "enqueued"
+STAGE_FORWARDED = "forwarded"
+STAGE_REPLY = "reply"
+STAGE_SENT = "sent"
+
+PREVIOUS_STAGE: typing.Dict[str, str] = {
+    STAGE_ENQUEUED: STAGE_RECEIVED,
+    STAGE_FORWARDED: STAGE_ENQUEUED,
+    STAGE_REPLY: STAGE_FORWARDED,
+    STAGE_SENT: STAGE_REPLY,
+}
+""" Stage latencies are measured from """
+
+BUCKETS: typing.Tuple[float, ...] = (
+    0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+    1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0,
+)
+""" Histogram bucket upper bounds in seconds """
+
+
+class LatencyHistogram(object):
+    """ Fixed bucket latency histogram """
+
+    def __init__(self) -> None:
+        self.counts: typing.List[int] = [0] * (len(BUCKETS) + 1)
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+
+    def add(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p: float) -> float:
+        """
+        Estimate percentile (upper bound of bucket)
+
+        :param p: Percentile (0.0 - 1.0)
+        :return: Latency in seconds
+        """
+        if not self.count:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'buckets': {
+                (str(BUCKETS[i]) if i < len(BUCKETS) else "inf"): n
+                for i, n in enumerate(self.counts)
+                if n
+            },
+        }
+
+
+class Tracer(object):
+    """ Record stage timestamps of messages and per stage latencies """
+
+    def __init__(
+            self, settings: typing.Optional[typing.Dict[str, typing.Any]] = None
+    ) -> None:
+        """
+        Initialize object
+
+        :param settings: Settings for instance (default: None)
+        """
+        if settings is None:
+            settings = {}
+        self._max_traces: int = settings.get('trace_max_pending', 10000)
+        """ Traces kept (oldest dropped) """
+        self._traces: typing.MutableMapping[
+            str, typing.Dict[str, float]
+        ] = OrderedDict()
+        self._histograms: typing.Dict[str, LatencyHistogram] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, name: str, value: float) -> None:
+        hist = self._histograms.get(name)
+        if hist is None:
+            hist = self._histograms[name] = LatencyHistogram()
+        hist.add(max(0.0, value))
+
+    def start(
+            self, sent_at: typing.Optional[datetime.datetime] = None,
+            received_at: typing.Optional[float] = None,
+    ) -> str:
+        """
+        Start trace for received message
+
+        :param sent_at: Message date from telegram
+        :param received_at: Time message was received (None -> now)
+        :return: Trace id
+        """
+        trace_id = uuid.uuid4().hex
+        now = received_at if received_at is not None else time.time()
+
+        with self._lock:
+            self._traces[trace_id] = {STAGE_RECEIVED: now}
+            if len(self._traces) > self._max_traces:
+                self._traces.popitem(last=False)
+            if sent_at:
+                # Telegram delivery (second resolution)
+                self._add("telegram", now - sent_at.timestamp())
+        return trace_id
+
+    def mark(self, trace_id: typing.Optional[str], stage: str) -> None:
+        """
+        Record stage reached
+
+        :param trace_id: Trace id (None -> ignored)
+        :param stage: Stage
+        """
+        if not trace_id:
+            return
+        now = time.time()
+
+        with self._lock:
+            trace = self._traces.get(trace_id)
+            if trace is None:
+                return
+            previous = trace.get(PREVIOUS_STAGE.get(stage))
+            if previous is not None:
+                self._add(
+                    "{}-{}".format(PREVIOUS_STAGE[stage], stage),
+                    now - previous
+                )
+            if stage == STAGE_SENT:
+                self._add("total", now - trace[STAGE_RECEIVED])
+            trace[stage] = now
+
+    def get_trace(
+            self, trace_id: str
+    ) -> typing.Optional[typing.Dict[str, float]]:
+        with self._lock:
+            trace = self._traces.get(trace_id)
+            return dict(trace) if trace is not None else None
+
+    def get_stats(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        """
+        Latency histograms by stage
+
+        :return: Histograms
+        """
+        with self._lock:
+            return {
+                name: hist.to_dict() for name, hist in self._histograms.items()
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms = {}
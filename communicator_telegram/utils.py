@@ -0,0 +1,89 @@
+# -*- coding: UTF-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+__author__ = "d01"
+__email__ = "jungflor@gmail.com"
+__copyright__ = "Copyright (C) 2017-20, Florian JUNG"
+__license__ = "MIT"
+__version__ = "0.1.0"
+__date__ = "2026-10-19"
+# Created: 2026-10-19 10:12
+
+import threading
+import time
+import typing
+
+
+def run_parallel(
+        steps: typing.List[typing.Tuple[str, typing.Callable[[], typing.Any]]],
+        timeout: typing.Optional[float] = None,
+) -> typing.Dict[str, BaseException]:
+    """
+    Run steps concurrently in daemon threads and wait for them to finish
+
+    :param steps: Name and function of each step
+    :param timeout: Overall time to wait for all steps (None -> no limit)
+    :return: Failed steps mapped to their exception
+        (TimeoutError if still running when the timeout expired)
+    """
+    errors: typing.Dict[str, BaseException] = {}
+    lock = threading.Lock()
+
+    def wrapper(name, function):
+        try:
+            function()
+        except BaseException as e:
+            with lock:
+                errors[name] = e
+
+    threads = []
+
+    for name, function in steps:
+        thread = threading.Thread(
+            target=wrapper, args=(name, function), name=name
+        )
+        thread.daemon = True
+        thread.start()
+        threads.append((name, thread))
+
+    deadline = Deadline(timeout)
+
+    for name, thread in threads:
+        thread.join(deadline.remaining())
+
+    with lock:
+        for name, thread in threads:
+            if thread.is_alive():
+                errors[name] = TimeoutError("{} still running".format(name))
+        return dict(errors)
+
+
+class Deadline(object):
+    """ Point in time shared by several bounded operations """
+
+    def __init__(self, timeout: typing.Optional[float]) -> None:
+        """
+        Initialize object
+
+        :param timeout: Seconds from now (None -> never expires)
+        """
+        self._end: typing.Optional[float] = None
+        if timeout is not None:
+            self._end = time.monotonic() + timeout
+
+    def remaining(self) -> typing.Optional[float]:
+        """
+        Time left until the deadline
+
+        :return: Seconds left (at least 0.0) or None if never expiring
+        """
+        if self._end is None:
+            return None
+        return max(0.0, self._end - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self._end is not None and time.monotonic() >= self._end
@@ -14,15 +14,16 @@ __date__ = "2020-04-14"
 
 import errno
 import threading
-import time
 
 from flotils.runable import SignalStopWrapper
 from flotils import StartStopable, Loadable
-from nameko.standalone.rpc import ClusterRpcProxy
 from alexander_fw import setup_kombu, RPCListener
 from alexander_fw.service import event_dispatcher
 
 from communicator_telegram import StandaloneTelegramService, TelegramClient
+from communicator_telegram.forwarder import ChatForwarder
+from communicator_telegram.profiler import tag_thread
+from communicator_telegram.utils import run_parallel, Deadline
 
 
 class TelegramRunner(Loadable, StartStopable, SignalStopWrapper):
@@ -53,11 +54,26 @@ class TelegramRunner(Loadable, StartStopable, SignalStopWrapper):
         nameko_settings['service'] = self.service
         nameko_settings['allowed_functions'] = self.service.allowed
         self.listener = RPCListener(nameko_settings)
-        self._cluster_proxy = ClusterRpcProxy(
-            nameko_settings, timeout=nameko_settings.get('rpc_timeout', None)
-        )
+        self.forwarder = ChatForwarder(self.service.forward, settings)
+        """ Forward messages to framework (parallel across chats) """
+        self._nameko_settings = nameko_settings
+        self._cluster_proxy = None
+        """ Created when connecting (defers nameko rpc import) """
         self._proxy = None
+        self._proxy_ready = threading.Event()
+        """ Proxy connected or given up on """
+        self._proxy_tries: int = settings.get('rpc_connect_tries', 3)
+        self._proxy_delay: float = settings.get('rpc_connect_delay', 1.0)
+        """ Initial delay between connection tries (doubles every try) """
+        self._proxy_wait: float = settings.get('rpc_proxy_wait', 10.0)
+        """ Max total time user lookups wait for proxy after start """
+        self._proxy_deadline = Deadline(0.0)
+        """ Afterwards lookups fail fast while proxy is not ready """
         self._done = threading.Event()
+        self._shutdown_timeout: float = settings.get('shutdown_timeout', 10.0)
+        """ Max time for the whole shutdown """
+        self._shutdown_lock = threading.Lock()
+        self._is_shut_down = False
         self._polling_timeout = settings.get('polling_interval', 2.0)
 
     def _thread_wrapper(self, function, *args, **kwargs):
@@ -74,28 +90,26 @@ class TelegramRunner(Loadable, StartStopable, SignalStopWrapper):
             self.exception("Threaded execution failed")
 
     def _run_message_watcher(self):
+        # Might run in main thread
+        tag_thread("watcher")
         timeout = self._polling_timeout
         while not self._done.wait(timeout):
-            if self.telegram.new_command.is_set():
-                cmds = self.service.pop_commands()
-                for cmd in cmds:
-                    try:
-                        im = self.service.to_input_message(cmd)
-                        self.service.communicate(im)
-                    except:
-                        self.exception(
-                            "Failed to communicate message\n{}".format(im)
-                        )
-            if self.telegram.new_text.is_set():
-                txts = self.service.pop_texts()
-                for txt in txts:
+            if self.telegram.new_command.is_set() \
+                    or self.telegram.new_text.is_set():
+                msgs = self.service.pop_batch()
+                for i, msg in enumerate(msgs):
+                    chat = msg.get('chat') or msg.get('user') or {}
                     try:
-                        im = self.service.to_input_message(txt)
-                        self.service.communicate(im)
-                    except:
-                        self.exception(
-                            "Failed to communicate message\n{}".format(im)
-                        )
+                        # Blocks while too many messages are in flight
+                        while not self.forwarder.submit(
+                                chat.get('id'), msg, self._polling_timeout
+                        ):
+                            if self._done.is_set():
+                                raise RuntimeError("Stopped")
+                    except RuntimeError:
+                        # Shutting down -> keep for cache
+                        self.telegram.requeue(msgs[i:])
+                        return
             if self.telegram.new_text.is_set() \
                     or self.telegram.new_command.is_set():
                 # Got more messages -> don't sleep
@@ -103,15 +117,74 @@ class TelegramRunner(Loadable, StartStopable, SignalStopWrapper):
             else:
                 timeout = self._polling_timeout
 
+    def _run_proxy_connect(self):
+        """
+        Connect rpc proxy (retrying with exponential backoff)
+        """
+        from nameko.standalone.rpc import ClusterRpcProxy
+
+        self.debug("Starting rpc proxy..")
+        tries = self._proxy_tries
+        sleep_time = self._proxy_delay
+
+        try:
+            self._cluster_proxy = ClusterRpcProxy(
+                self._nameko_settings,
+                timeout=self._nameko_settings.get('rpc_timeout', None)
+            )
+
+            while tries > 0:
+                self.debug("Trying to establish nameko proxy..")
+                try:
+                    self._proxy = self._cluster_proxy.start()
+                except Exception:
+                    if tries <= 1:
+                        raise
+                    self.exception("Failed to connect proxy")
+                    self.info("Sleeping {}s".format(round(sleep_time, 2)))
+                    if self._done.wait(sleep_time):
+                        # Stopped while waiting
+                        return
+                    sleep_time *= 2
+                else:
+                    break
+                tries -= 1
+        except Exception:
+            self.exception("Failed to start rpc proxy")
+            self.stop()
+            return
+        finally:
+            self._proxy_ready.set()
+
+        self.service.proxy = self._proxy
+        self.info("RPC proxy running")
+
+    def _wait_proxy(self):
+        """
+        Wait for proxy connection to finish
+
+        Waiting blocks the dispatcher, so all lookups share one bounded
+        wait after start and fail fast afterwards
+
+        :return: Proxy or None
+        """
+        if not self._proxy_ready.is_set():
+            remaining = self._proxy_deadline.remaining()
+            if remaining:
+                self.debug("Waiting for proxy..")
+                self._proxy_ready.wait(remaining)
+        return self._proxy
+
     def _dispatch_intent(self, event_type, event_data):
         self.dispatcher("manager_intent", event_type, event_data)
 
     def _rpc_service_user_get_authorized(self, user_id):
         self.debug("({})".format(user_id))
-        if not self._proxy:
-            self.warning("No proxy available")
-            return None
-        resp = self._proxy.service_user.get_authorized(
+        proxy = self._wait_proxy()
+        if not proxy:
+            # Failed lookup, not an unknown user
+            raise IOError("No proxy available")
+        resp = proxy.service_user.get_authorized(
             self.service.name, user_id
         )
         if not resp:
@@ -130,11 +203,12 @@ class TelegramRunner(Loadable, StartStopable, SignalStopWrapper):
             return eid
         if not meta or not meta.get('mapped_user'):
             return None
-        if not self._proxy:
+        proxy = self._wait_proxy()
+        if not proxy:
             self.warning("No proxy available")
             return None
 
-        resp = self._proxy.service_user.external_id(
+        resp = proxy.service_user.external_id(
             meta['mapped_user'], self.service.name
         )
         if not resp:
@@ -144,47 +218,47 @@ class TelegramRunner(Loadable, StartStopable, SignalStopWrapper):
     def start(self, blocking=False):
         self.debug("()")
         super(TelegramRunner, self).start(False)
-        self.debug("Starting rpc proxy..")
-        tries = 3
-        sleep_time = 1.4
-
-        while tries > 0:
-            self.debug("Trying to establish nameko proxy..")
-            try:
-                self._proxy = self._cluster_proxy.start()
-            except Exception:
-                if tries <= 1:
-                    raise
-                self.exception("Failed to connect proxy")
-                self.info("Sleeping {}s".format(round(sleep_time, 2)))
-                time.sleep(sleep_time)
-                sleep_time **= 2
-            else:
-                break
-            tries -= 1
-
-        self.service.proxy = self._proxy
-        self.debug("Starting telegram client..")
-
-        try:
-            self.telegram.start(False)
-        except Exception:
-            self.exception("Failed to start telegram client")
+        self._done.clear()
+        self._proxy_ready.clear()
+        self._proxy_deadline = Deadline(self._proxy_wait)
+        with self._shutdown_lock:
+            self._is_shut_down = False
+
+        # Only user lookups need the proxy -> connect in background
+        a_thread = threading.Thread(
+            target=self._thread_wrapper, args=(self._run_proxy_connect,),
+            name="rpc-proxy-connect"
+        )
+        a_thread.daemon = True
+        a_thread.start()
+
+        self.debug("Starting telegram client and rpc listener..")
+        errors = run_parallel([
+            ("telegram client", lambda: self.telegram.start(False)),
+            ("rpc listener", lambda: self.listener.start(False)),
+        ])
+
+        for name, error in errors.items():
+            self.error("Failed to start {}".format(name), exc_info=error)
+        if errors:
             self.stop()
             return
-
-        self.info("Telegram client running")
-        self.debug("Starting rpc listener..")
-
-        try:
-            self.listener.start(False)
-        except Exception:
-            self.exception("Failed to start rpc listener")
-            self.stop()
+        with self._shutdown_lock:
+            stopped = self._is_shut_down
+        if stopped:
+            # Stopped (e.g. proxy failed) while starting -> stop again
+            # what only finished starting after that
+            self.warning("Stopped while starting")
+            errors = run_parallel([
+                ("rpc listener", self._stop_listener),
+                ("telegram client", self._stop_telegram),
+            ], self._shutdown_timeout)
+            for name, error in errors.items():
+                self.error("Failed to stop {}".format(name), exc_info=error)
             return
 
-        self.info("RPC listener running")
-        self._done.clear()
+        self.info("Telegram client and RPC listener running")
+        self.forwarder.start()
 
         if blocking:
             try:
@@ -202,7 +276,8 @@ class TelegramRunner(Loadable, StartStopable, SignalStopWrapper):
             try:
                 a_thread = threading.Thread(
                     target=self._thread_wrapper,
-                    args=(self._run_message_watcher,)
+                    args=(self._run_message_watcher,),
+                    name="telegram-watcher"
                 )
                 a_thread.daemon = True
                 a_thread.start()
@@ -211,33 +286,70 @@ class TelegramRunner(Loadable, StartStopable, SignalStopWrapper):
                 self.stop()
                 return
 
-    def stop(self):
-        self.debug("()")
-        self._done.set()
-        super(TelegramRunner, self).stop()
+    def _stop_listener(self):
         self.debug("Stopping rpc listener")
-        try:
-            self.listener.stop()
-        except:
-            self.exception("Failed to stop rpc listener")
-        else:
-            self.info("RPC listener stopped")
+        self.listener.stop()
+        self.info("RPC listener stopped")
+
+    def _stop_telegram(self, timeout=None):
         self.debug("Stopping telegram client")
-        try:
-            self.telegram.stop()
-        except:
-            self.exception("Failed to stop telegram client")
-        else:
-            self.info("Telegram client stopped")
+        self.telegram.stop(timeout)
+        self.info("Telegram client stopped")
+
+    def _stop_proxy(self):
         self.debug("Stopping cluster proxy..")
         try:
-            self._cluster_proxy.stop()
-        except:
-            self.exception("Failed to stop cluster proxy")
-        else:
-            self.info("RPC proxy stopped")
+            if self._cluster_proxy:
+                self._cluster_proxy.stop()
         finally:
             self._proxy = None
+        self.info("RPC proxy stopped")
+
+    def stop(self):
+        self.debug("()")
+        with self._shutdown_lock:
+            if self._is_shut_down:
+                self.debug("Already stopped")
+                return
+            self._is_shut_down = True
+        deadline = Deadline(self._shutdown_timeout)
+        # Keep time for the client to save its cache
+        drain = Deadline(
+            max(0.0, self._shutdown_timeout - self.telegram.save_reserve)
+        )
+        self._done.set()
+        super(TelegramRunner, self).stop()
+
+        # Ingress first -> nothing new gets queued while tearing down
+        self.debug("Stopping telegram ingress")
+        try:
+            self.telegram.stop_ingress(drain.remaining())
+        except Exception:
+            self.exception("Failed to stop telegram ingress")
+
+        # Finish forwarding in progress, keep the rest for cache
+        self.debug("Stopping forwarder")
+        try:
+            self.telegram.requeue(self.forwarder.stop(drain.remaining()))
+        except Exception:
+            self.exception("Failed to stop forwarder")
+
+        # Client drains outgoing and saves queues within the same deadline
+        errors = run_parallel([
+            ("rpc listener", self._stop_listener),
+            (
+                "telegram client",
+                lambda: self._stop_telegram(deadline.remaining())
+            ),
+            ("cluster proxy", self._stop_proxy),
+        ], deadline.remaining())
+
+        for name, error in errors.items():
+            self.error("Failed to stop {}".format(name), exc_info=error)
+        if errors:
+            self.warning("Shutdown incomplete after {}s".format(
+                self._shutdown_timeout
+            ))
 
 
 if __name__ == "__main__":